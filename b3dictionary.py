@@ -8,52 +8,307 @@
 #              eight times faster than grep for search. I have tested it up to 100 million keys.                   #
 #                                                                                                                  #
 # Features:                                                                                                        #
-#           - Node cache to save disk seeks with hit ratio of 40%                                                  #
+#           - LRU node cache to save disk seeks, with the root node always cached                                  #
 #           - Ballance in thread and split/merge modes                                                             #
 #           - Statistics for splits, merges, keys, levels, cache hit and miss, thread ballances to left and right. #
 #           - Behaves as iterator, in both direct and reverse order                                                #
 #           - On insertion, if key already exists, it will update data                                             #
 #           - On deletion and read, if key doen't exist, raises exception                                          #
 #           - Consistency check when using an existing b-tree                                                      #
-#           - Stores data as JSON                                                                                  #
+#           - Stores nodes in a fixed-size binary layout and data as JSON                                          #
+#           - Optional compiled node helpers: python setup.py build_ext --inplace                                  #
 #           - Keeps track and reuses free space to avoid fragmentation. Shrinks file if too many free space.       #
+#           - Keeps internal nodes together right after the header, apart from the leaves                          #
 #                                                                                                                  #
 # Usage:                                                                                                           #
 #           - Open existing tree file:  my_tree = b3dict( filename )                                               #
-#           - Create new tree file:     my_tree = b3dict( filename, num_keys, key_size, data_size )                #
+#           - Create new tree file:     my_tree = b3dict( filename, num_keys, key_size, data_size, cache_size )    #
 #           - Adding or Updating:       my_tree[key] = data                                                        #
 #           - Removing items:           del my_tree[key]                                                           #
 #           - Reading data              data  = my_tree[key]                                                       #
 #           - Iterate in direct order:  for key in my_tree:                                                        #
 #           - Iterate in reverse order: for key in reversed( my_tree ):                                            #
+#           - Closing on exit:          with b3dict( filename ) as my_tree:                                        #
 #                                                                                                                  #
 # Methods:                                                                                                         #
 #           - check_consistency()       Scans the tree looking for inconsistencies in pointers and keys.           #
 #           - stats()                   Returns dictionary with all the statistics.                                #
+#           - close()                   Writes pending changes to disk and closes the file.                        #
+#           - update( pairs )           Inserts many pairs, sorted by key, reusing the leaf node while they fit.   #
+#           - bulk_load()               Context manager where deletions skip ballance, compacting once at the end. #
+#           - rebalance_percent         Constructor option: below 100, deletions leave nodes partly under minimum  #
+#                                       occupation. They are ballanced on close(), or on next open after a crash.  #
 #                                                                                                                  #
 ####################################################################################################################
 
 from collections.abc import MutableMapping
+from collections import OrderedDict
+from contextlib import contextmanager
 from os.path import exists
-from math import trunc
+import os
+from math import trunc, isfinite
+from bisect import bisect_left, insort
+from array import array
+import struct
+import mmap
 import json
+import re
+import logging
+from dataclasses import dataclass
+
+# Inconsistencies found by check_consistency() are reported here
+_log = logging.getLogger( __name__ )
+
+# Data is JSON, written the same way with or without orjson: compact separators,
+# and values orjson can't write as themselves (NaN, infinities and ints beyond 64
+# bits) are written by json with a leading blank, still valid JSON, so readers
+# know to decode them with json as well.
+def _json_std( obj ):
+    return json.dumps( obj, ensure_ascii=False, separators=( ',', ':' ) ).encode()
+
+def _json_std_only( obj ):
+
+    # Whether obj holds a non-finite float or an int beyond 64 bits
+    stack = [ obj ]
+    while stack:
+        obj = stack.pop()
+        if isinstance( obj, float ):
+            if not isfinite( obj ):
+                return True
+        elif isinstance( obj, int ):
+            if obj < -2**63 or obj >= 2**64:
+                return True
+        elif isinstance( obj, dict ):
+            stack.extend( obj.keys() )
+            stack.extend( obj.values() )
+        elif isinstance( obj, ( list, tuple ) ):
+            stack.extend( obj )
+    return False
+
+# Use orjson when available, it's several times faster than json
+try:
+    import orjson
+
+    def _json_dumps( obj ):
+
+        # orjson refuses ints beyond 64 bits, and writes non-finite floats as null
+        try:
+            data = orjson.dumps( obj, option=orjson.OPT_NON_STR_KEYS )
+        except TypeError:
+            return b' ' + _json_std( obj )
+        if b'null' in data and _json_std_only( obj ):
+            return b' ' + _json_std( obj )
+        return data
+
+    def _json_loads( data ):
+        if data[:1] == b' ':
+            return json.loads( data )
+        return orjson.loads( data )
+
+except ImportError:
+
+    # Only output holding these can need the blank
+    _json_std_hint = re.compile( rb'NaN|Infinity|\d{19}' )
+
+    def _json_dumps( obj ):
+        data = _json_std( obj )
+        if _json_std_hint.search( data ) and _json_std_only( obj ):
+            return b' ' + data
+        return data
+
+    _json_loads = json.loads
+
+# --------------------------------------------------------------------------
+
+# Use compiled node helpers when built (see b3node.pyx), otherwise plain Python
+try:
+    from b3node import split_keys as _split_keys, split_data as _split_data
+    from b3node import search_keys as _search_keys
+
+except ImportError:
+
+    def _split_keys( slab, key_size ):
+        return [ slab[pos:pos+key_size] for pos in range( 0, len( slab ), key_size ) ]
+
+    def _split_data( slab, data_size ):
+        return [ slab[pos:pos+data_size].rstrip( b'\0' ) for pos in range( 0, len( slab ), data_size ) ]
+
+    def _search_keys( slab, n, key, key_size ):
+        low = 0
+        high = n
+        while low < high:
+            mid = ( low + high ) >> 1
+            if slab[mid*key_size:(mid+1)*key_size] < key:
+                low = mid + 1
+            else:
+                high = mid
+        return low, low < n and slab[low*key_size:(low+1)*key_size] == key
+
+# --------------------------------------------------------------------------
+
+@dataclass( frozen = True, slots = True )
+class _Sizes:
+
+    # Node layout, fixed for the life of a tree file: node size rounded up to whole
+    # pages, slot sizes and where key, data and lower slots start within a node
+    node_size: int
+    key_size: int
+    data_size: int
+    key_base: int
+    data_base: int
+    lower_base: int
+
+def _compute_sizes( tree_header, node_header_size, page_size ):
+
+    num_keys = tree_header['num_keys']
+    key_size = tree_header['key_size']
+    data_size = tree_header['data_size']
+    data_base = node_header_size + num_keys * key_size
+    lower_base = data_base + num_keys * data_size
+    node_size = lower_base + ( num_keys + 1 ) * struct.calcsize( '<Q' )
+    node_size = ( node_size + page_size - 1 ) // page_size * page_size
+    return _Sizes( node_size, key_size, data_size, node_header_size, data_base, lower_base )
+
+# --------------------------------------------------------------------------
+
+class _Node:
+
+    # In-memory node: pointers to itself and neighbors, sorted keys, JSON encoded
+    # data for each key and, unless it's a leaf, offsets of the len(keys)+1 lower nodes.
+    # Nodes read from file keep keys and data as raw slabs of fixed-size slots, and
+    # only split them into lists when they are first accessed. Data slots aren't even
+    # read until then, lookups that only compare keys never touch them. A node never
+    # changes level, so whether it's a leaf is kept as a flag instead of testing lowers.
+    __slots__ = ( 'offset', 'upper', 'left', 'right', 'leaf', 'lowers', '_count', '_keys', '_data', '_key_slab', '_data_slab',
+                  '_mm', '_data_span' )
+
+    def __init__( self, offset, upper = 0, left = 0, right = 0, count = 0, key_slab = b'', data_slab = b'', mm = None, data_span = None ):
+        self.offset = offset
+        self.upper = upper
+        self.left = left
+        self.right = right
+        self.leaf = True
+        self.lowers = array( 'Q' )
+        self._count = count
+        self._keys = None if count else []
+        self._data = None if count else []
+        self._key_slab = key_slab
+        self._data_slab = data_slab
+        self._mm = mm
+        self._data_span = data_span
+
+    @property
+    def keys( self ):
+        if self._keys is None:
+            self._keys = _split_keys( self._key_slab, len( self._key_slab ) // self._count )
+            self._key_slab = b''
+        return self._keys
+
+    @keys.setter
+    def keys( self, keys ):
+        self._keys = keys
+        self._key_slab = b''
+
+    @property
+    def data( self ):
+        if self._data is None:
+            slab = self.read_data()
+            self._data = _split_data( slab, len( slab ) // self._count )
+            self._data_slab = b''
+        return self._data
+
+    @data.setter
+    def data( self, data ):
+        self._data = data
+        self._data_slab = b''
+        self._mm = None
+
+    def read_data( self ):
+
+        # Copy data slots from the mapped file, if not done yet. Must happen before the
+        # node leaves its offset or the map is replaced
+        if self._mm is not None:
+            self._data_slab = self._mm[self._data_span]
+            self._mm = None
+        return self._data_slab
+
+    def data_pending( self ):
+        return self._mm is not None
+
+    def search( self, key ):
+
+        # Position of key and whether it's there, straight on the slab if not split
+        if self._keys is None:
+            count = self._count
+            size = len( self._key_slab ) // count
+            if len( key ) == size:
+                return _search_keys( self._key_slab, count, key, size )
+        keys = self.keys
+        pos = bisect_left( keys, key )
+        return pos, pos < len( keys ) and keys[pos] == key
+
+    def get_key( self, pos ):
+
+        # Single key slot, without splitting the slab
+        if self._keys is None:
+            size = len( self._key_slab ) // self._count
+            return self._key_slab[pos*size:pos*size+size]
+        return self._keys[pos]
+
+    def get_data( self, pos ):
+
+        # Single data slot, without splitting the slab
+        if self._data is None:
+            if self._mm is not None:
+                span = self._data_span
+                size = ( span.stop - span.start ) // self._count
+                return self._mm[span.start+pos*size:span.start+pos*size+size].rstrip( b'\0' )
+            size = len( self._data_slab ) // self._count
+            return self._data_slab[pos*size:pos*size+size].rstrip( b'\0' )
+        return self._data[pos]
+
+    def num_keys( self ):
+        return self._count if self._keys is None else len( self._keys )
+
+    def key_slab( self ):
+        return self._key_slab if self._keys is None else b''.join( self._keys )
+
+    def data_slab( self, data_size ):
+        if self._data is None:
+            return self.read_data()
+        return b''.join( [ data.ljust( data_size, b'\0' ) for data in self._data ] )
+
+# --------------------------------------------------------------------------
 
 class b3dict( MutableMapping ):
 
-    def __init__( self, file_name:str = 'b3dict.b3', num_keys:int = 512, key_size:int = 64, data_size:int = 256 ):
+    def __init__( self, file_name:str = 'b3dict.b3', num_keys:int = 512, key_size:int = 64, data_size:int = 256, cache_size:int = 256, rebalance_percent:int = 100 ):
 
         corrupt = False
 
-        # Iterator
-        self.__iter_node = None
-        self.__iter_dir = 'direct'
-        self.__iter_pos = 0
+        # Memory map of the whole tree file
+        self.__mm = None
+
+        # Header and node changes are written once per operation. When only
+        # statistics changed, header is written every few operations
+        self.__header_dirty = False
+        self.__stats_dirty = False
+        self.__stats_ops = 0
+        self.__stats_flush_ops = 64
+        self.__dirty_nodes = {}
+
+        # Offsets of nodes deletions left under minimum occupation, for compaction
+        self.__underflowed = set()
+
+        # Read-ahead hints for nodes about to be loaded, where supported
+        self.__madvise = hasattr( mmap, 'MADV_WILLNEED' )
 
-        # Node cache
-        self.__node_cache = []
-        self.__cache_size = 32
+        # Node cache, least recently used first. Root is never evicted.
+        self.__node_cache = OrderedDict()
+        self.__cache_size = cache_size
         
         # Manual limits
+        self.__min_cache_size = 1
         self.__min_num_keys = 3
         self.__max_num_keys = 1024
         self.__min_key_size = 1
@@ -62,8 +317,14 @@ class b3dict( MutableMapping ):
         self.__max_data_size = 4096
         self.__max_free_nodes = 10
         self.__max_offset_digits = 14 # ext4 max file size is 16T, which takes 14 digits to address.
-        self.__empty_tree_header_size = 249 # With stats
-        self.__empty_node_size = 100
+        self.__max_stat_digits = 20 # Statistics are counted up to 2^64
+        self.__empty_tree_header_size = 324 # With stats and version, without values
+        self.__version = 6
+        self.__page_size = 4096 # Header takes the first page and nodes are page aligned
+        self.__band_slots = 32 # Internal nodes are kept together right after the header
+
+        # Binary node layout: offset, upper, left, right, number of keys, number of lower nodes
+        self.__node_header = struct.Struct( '<QQQQHH' )
         
         # Check parameter types
         if not isinstance( file_name, str ):
@@ -74,6 +335,10 @@ class b3dict( MutableMapping ):
             raise TypeError( '<key_size> must be an int.' )
         if not isinstance( data_size, int ):
             raise TypeError( '<data_size> must be an int.' )
+        if not isinstance( cache_size, int ):
+            raise TypeError( '<cache_size> must be an int.' )
+        if not isinstance( rebalance_percent, int ):
+            raise TypeError( '<rebalance_percent> must be an int.' )
         
         # Check parameter values
         if num_keys > self.__max_num_keys or num_keys < self.__min_num_keys:
@@ -82,10 +347,16 @@ class b3dict( MutableMapping ):
             raise ValueError( '<key_size> must be between '+str(self.__min_key_size)+' and '+str(self.__max_key_size) )
         if data_size > self.__max_data_size or data_size < self.__min_data_size:
             raise ValueError( '<data_size> must be between '+str(self.__min_data_size)+' and '+str(self.__max_data_size) )
+        if cache_size < self.__min_cache_size:
+            raise ValueError( '<cache_size> must be at least '+str(self.__min_cache_size) )
+        if rebalance_percent > 100 or rebalance_percent < 0:
+            raise ValueError( '<rebalance_percent> must be between 0 and 100' )
+
+        # Deletions rebalance nodes below this percent of minimum occupation
+        self.__rebalance_percent = rebalance_percent
 
         # Set private attributes
         self.__file_name = file_name
-        self.__min_occup = trunc( num_keys / 3 )
 
         # Calculate digits of limits
         self.__max_num_keys_digits = len(str(self.__max_num_keys))
@@ -97,39 +368,62 @@ class b3dict( MutableMapping ):
         self.__max_tree_header_size += self.__max_num_keys_digits
         self.__max_tree_header_size += self.__max_key_size_digits
         self.__max_tree_header_size += self.__max_data_size_digits
-        self.__max_tree_header_size += self.__max_offset_digits
-        self.__max_tree_header_size += self.__max_free_nodes * ( 2 + self.__max_offset_digits )
-        self.__max_tree_header_size += 7 * 20
+        self.__max_tree_header_size += len(str(self.__version))
+        self.__max_tree_header_size += 4 * self.__max_offset_digits
+        self.__max_tree_header_size += 2 * ( self.__max_free_nodes + 1 ) * ( 2 + self.__max_offset_digits )
+        self.__max_tree_header_size += 9 * self.__max_stat_digits
+        self.__max_tree_header_size += len( 'false' )
 
         # If file exists Load header
         if exists( self.__file_name ):
+            fd = os.open( self.__file_name, os.O_RDWR )
             try:
-                fd = open( self.__file_name, 'r' )
-                self.__tree_header = json.loads( fd.readline() )
-                fd.close()
-                # Calculate buffer sizes
-                self.__max_node_size = self.__empty_node_size
-                self.__max_node_size += (3 * self.__max_offset_digits)
-                self.__max_node_size +=  self.__tree_header['num_keys'] * (self.__tree_header['key_size'] + 2)
-                self.__max_node_size +=  self.__tree_header['num_keys'] * (self.__tree_header['data_size'] + 2)
-                self.__max_node_size +=  ( self.__tree_header['num_keys'] + 1 ) * (self.__max_offset_digits + 2)
+                self.__mm = mmap.mmap( fd, 0 )
 
-            except json.decoder.JSONDecodeError:
-                corrupt = True
-                
-            # Check tree consistency
-            if not self.check_consistency():
+                # Header is the first line. Files from other versions may have shorter ones
+                self.__tree_header = _json_loads( self.__mm[:self.__mm.find( b'\n' ) + 1] )
+            except ( ValueError, UnicodeDecodeError ):
                 corrupt = True
+            os.close( fd )
+
+            # Refuse files written with another node layout
+            if not corrupt and self.__tree_header.get( 'version' ) != self.__version:
+                raise RuntimeError( 'B-Tree file version is not supported' )
+
+            if not corrupt:
+
+                # Prepare header template
+                self.__build_header__()
+
+                # Calculate buffer sizes
+                self.__sizes = _compute_sizes( self.__tree_header, self.__node_header.size, self.__page_size )
+
+                # Node capacity and minimum occupation, read on every operation
+                self.__num_keys = self.__tree_header['num_keys']
+                self.__min_occup = trunc( self.__num_keys / 3 )
+
+                # Check tree consistency
+                if not self.check_consistency():
+                    corrupt = True
+
+                # Ballance nodes left under minimum occupation by a run that didn't close
+                elif self.__tree_header['underflow']:
+                    self.__compact__( True )
 
         # Otherwise create file with header
         else:
             self.__tree_header = {
+                'version': self.__version,
                 'num_keys': num_keys,
                 'key_size': key_size,
                 'data_size': data_size,
-                'root_offset': self.__max_tree_header_size + 1,
-                'free_offset': [],
-                'last_offset': self.__max_tree_header_size + 1,
+                'root_offset': self.__page_size,
+                'band_offset': 0,
+                'next_internal_offset': self.__page_size,
+                'free_internal': [],
+                'free_leaf': [],
+                'last_offset': 0,
+                'underflow': False,
                 'stats': {
                     'nodes': 1,
                     'keys': 0,
@@ -142,457 +436,601 @@ class b3dict( MutableMapping ):
                     'cache miss': 0
                 }
             }
-            fd = open( self.__file_name, 'w' )
-            self.__save_header__( fd )
-            new_node = {
-                'offset': self.__tree_header['root_offset'],
-                'upper_node': 0,
-                'left_node': 0,
-                'right_node': 0,
-                'key': [],
-                'data': [],
-                'lower_node': []
-            }
+            new_node = _Node( self.__tree_header['root_offset'] )
             
             # Calculate buffer sizes
-            self.__max_node_size = self.__empty_node_size
-            self.__max_node_size += (3 * self.__max_offset_digits)
-            self.__max_node_size +=  self.__tree_header['num_keys'] * (self.__tree_header['key_size'] + 2)
-            self.__max_node_size +=  self.__tree_header['num_keys'] * (self.__tree_header['data_size'] + 2)
-            self.__max_node_size +=  ( self.__tree_header['num_keys'] + 1 ) * (self.__max_offset_digits + 2)
+            self.__sizes = _compute_sizes( self.__tree_header, self.__node_header.size, self.__page_size )
+
+            # Node capacity and minimum occupation, read on every operation
+            self.__num_keys = num_keys
+            self.__min_occup = trunc( num_keys / 3 )
+
+            # Internal nodes band follows the header, with the root as its first node.
+            # Leaves are appended after it.
+            self.__tree_header['band_offset'] = self.__page_size + self.__band_slots * self.__sizes.node_size
+            self.__tree_header['next_internal_offset'] = self.__page_size + self.__sizes.node_size
+            self.__tree_header['last_offset'] = self.__tree_header['band_offset'] - self.__sizes.node_size
 
-            self.__save_node__( fd, new_node )
+            # Size file for header and band, then map it. Unused band slots take no disk space
+            fd = os.open( self.__file_name, os.O_RDWR | os.O_CREAT, 0o644 )
+            os.ftruncate( fd, self.__tree_header['band_offset'] )
+            self.__mm = mmap.mmap( fd, 0 )
+            os.close( fd )
 
-        fd.close()
+            self.__build_header__()
+            self.__save_header__()
+            self.__save_node__( new_node )
+            self.__flush__()
 
         # Raise exception if corrupt
         if corrupt:
             raise RuntimeError('B-Tree file is corrupt')
 
-        # Calculate minimum occupation
-        self.__min_occup = trunc( self.__tree_header['num_keys'] / 3 )
+    # ----------------------------------------------------------------------
+
+    def __build_header__( self ):
+
+        # Lay the header out as JSON where every value that can change gets a
+        # fixed-width slot, so saving only has to patch slots in place
+        self.__header_slots = []
+        text = '{'
+        for field, value in self.__tree_header.items():
+            text += json.dumps( field ) + ': '
+
+            # Statistics counters
+            if field == 'stats':
+                text += '{'
+                for name in value:
+                    text += json.dumps( name ) + ': '
+                    self.__header_slots.append( ( len( text ), self.__max_stat_digits, field, name ) )
+                    text += ' ' * self.__max_stat_digits + ', '
+                text = text[:-2] + '}'
+
+            # Offsets
+            elif field in ( 'root_offset', 'next_internal_offset', 'last_offset' ):
+                self.__header_slots.append( ( len( text ), self.__max_offset_digits, field, None ) )
+                text += ' ' * self.__max_offset_digits
+
+            # Lists of free offsets
+            elif field in ( 'free_internal', 'free_leaf' ):
+                width = ( self.__max_free_nodes + 1 ) * ( 2 + self.__max_offset_digits )
+                self.__header_slots.append( ( len( text ), width, field, None ) )
+                text += ' ' * width
+
+            # Deferred underflow flag
+            elif field == 'underflow':
+                self.__header_slots.append( ( len( text ), len( 'false' ), field, None ) )
+                text += ' ' * len( 'false' )
+
+            # Fixed values
+            else:
+                text += json.dumps( value )
+
+            text += ', '
+        text = text[:-2] + '}'
+
+        if len( text ) > self.__max_tree_header_size:
+            raise RuntimeError( 'B-Tree file is corrupt' )
+
+        self.__header_buf = bytearray( ( text.ljust( self.__max_tree_header_size, ' ' ) + '\n' ).encode() )
 
     # ----------------------------------------------------------------------
 
-    def __save_header__( self, fd ):
-        fd.seek( 0 )
-        fd.write( json.dumps( self.__tree_header ).ljust( self.__max_tree_header_size, ' ' ) + '\n' )
+    def __save_header__( self ):
+
+        # Patch slots
+        buf = self.__header_buf
+        for pos, width, field, name in self.__header_slots:
+            value = self.__tree_header[field]
+            if name is not None:
+                value = value[name]
+            buf[pos:pos+width] = _json_dumps( value ).ljust( width )
+
+        # Save to file
+        self.__mm[:len( buf )] = buf
+        self.__header_dirty = False
+        self.__stats_ops = 0
+
+    # ----------------------------------------------------------------------
+
+    def __flush__( self, force = False ):
+
+        # Write each changed node once, in file order
+        if self.__dirty_nodes:
+            for offset in sorted( self.__dirty_nodes ):
+                self.__write_node__( self.__dirty_nodes[offset] )
+            self.__dirty_nodes.clear()
+
+        # Count operations that changed statistics only
+        if self.__stats_dirty:
+            self.__stats_dirty = False
+            self.__stats_ops += 1
+
+        # Write header once if the operation changed it, or if statistics are due
+        if self.__header_dirty or self.__stats_ops >= self.__stats_flush_ops or ( force and self.__stats_ops > 0 ):
+            self.__save_header__()
 
-        
     # ----------------------------------------------------------------------
 
-    def __save_node__( self, fd, node ):
+    def __resize__( self, size ):
+
+        # Grow or shrink file together with its memory map
+        try:
+            self.__mm.resize( size )
+
+        # Platforms without mremap: remap the resized file, once nodes in memory
+        # have read their data from the old map
+        except SystemError:
+            for node in list( self.__node_cache.values() ) + list( self.__dirty_nodes.values() ):
+                node.read_data()
+            fd = os.open( self.__file_name, os.O_RDWR )
+            self.__mm.close()
+            os.ftruncate( fd, size )
+            self.__mm = mmap.mmap( fd, 0 )
+            os.close( fd )
+
+        # Forget pending writes past the end of file
+        for offset in [offset for offset in self.__dirty_nodes if offset >= size]:
+            del self.__dirty_nodes[offset]
+
+    # ----------------------------------------------------------------------
+
+    def __save_node__( self, node ):
 
         # Update cache
-        for cached_record in self.__node_cache:
-            if cached_record['offset'] == node['offset']:
-                cached_record['node'] = node.copy()
+        if node.offset in self.__node_cache:
+            self.__node_cache[node.offset] = node
+            self.__node_cache.move_to_end( node.offset )
+
+        # Defer write until the end of the operation
+        self.__dirty_nodes[node.offset] = node
+
+    # ----------------------------------------------------------------------
+
+    def __save_upper__( self, offset, upper ):
+
+        # Update just the upper pointer of a node, without loading it. A node in memory
+        # gets it there, and unless it's pending a full write, its 8 bytes (second field
+        # of the node header) are packed straight into the mapped file.
+        node = self.__node_cache.get( offset )
+        if node is None:
+            node = self.__dirty_nodes.get( offset )
+        if node is not None:
+            node.upper = upper
+        if offset not in self.__dirty_nodes:
+            struct.pack_into( '<Q', self.__mm, offset + 8, upper )
+
+    # ----------------------------------------------------------------------
+
+    def __write_node__( self, node ):
+
+        # Pack header straight into the mapped file
+        mm = self.__mm
+        self.__node_header.pack_into( mm, node.offset, node.offset, node.upper, node.left, node.right,
+                                      node.num_keys(), len( node.lowers ) )
+
+        # Pack key and data slots (data is already JSON encoded), each in one go
+        slab = node.key_slab()
+        pos = node.offset + self.__sizes.key_base
+        mm[pos:pos + len( slab )] = slab
+
+        # Data never read is still in place
+        if not node.data_pending():
+            slab = node.data_slab( self.__sizes.data_size )
+            pos = node.offset + self.__sizes.data_base
+            mm[pos:pos + len( slab )] = slab
 
-        # Save to disk
-        fd.seek( node['offset'] )
-        fd.write( json.dumps( node ).ljust( self.__max_node_size, ' ' ) )
+        # Pack lower node offsets
+        struct.pack_into( '<'+str(len( node.lowers ))+'Q', mm, node.offset + self.__sizes.lower_base, *node.lowers )
 
     # ----------------------------------------------------------------------
 
-    def __load_node__( self, fd, offset ):
+    def __load_node__( self, offset ):
 
         corrupt = False
         result = None
 
         # Check for cache hit
-        for cached_record in self.__node_cache:
-            if cached_record['offset'] == offset:
+        cached = self.__node_cache.get( offset )
+        if cached is not None:
 
-                # Statistics
-                cached_record['hits'] += 1
-                self.__tree_header['stats']['cache hit'] += 1
+            # Statistics
+            self.__node_cache.move_to_end( offset )
+            self.__tree_header['stats']['cache hit'] += 1
 
-                # Return cached node
-                return cached_record['node'].copy()
+            # Return cached node
+            return cached
 
         # If not, cache miss
         self.__tree_header['stats']['cache miss'] += 1
 
-        # Try to load node from disk
-        try:
-            fd.seek( offset )
-            result = json.loads( fd.read( self.__max_node_size ) )
-
-        # Unless its corrupt
-        except json.decoder.JSONDecodeError:
-            corrupt = True
+        # Evicted nodes not yet written are still pending, otherwise read them
+        result = self.__dirty_nodes.get( offset )
 
-        # If corrupt raise exception
-        if corrupt:
-            raise RuntimeError('B-Tree file is corrupt')
+        if result is None:
 
-        # Moving on: If cache is full
-        if len( self.__node_cache ) == self.__cache_size:
+            # Try to load node straight from the mapped file
+            try:
+                mm = self.__mm
+                if offset + self.__sizes.node_size > len( mm ):
+                    raise ValueError( 'node beyond end of file' )
+
+                # Unpack header
+                node_offset, upper, left, right, num_keys, num_lower = self.__node_header.unpack_from( mm, offset )
+                if node_offset != offset or num_keys > self.__num_keys or num_lower > num_keys + 1:
+                    raise ValueError( 'bad node header' )
+
+                # Copy key slots as a raw slab, they are split when needed. Data slots are
+                # only located, they are read when first needed
+                pos = offset + self.__sizes.key_base
+                key_slab = mm[pos:pos + num_keys * self.__sizes.key_size]
+                pos = offset + self.__sizes.data_base
+                data_span = slice( pos, pos + num_keys * self.__sizes.data_size )
+                result = _Node( offset, upper, left, right, num_keys, key_slab, b'', mm if num_keys else None, data_span )
+
+                # Unpack lower node offsets
+                result.lowers = array( 'Q', struct.unpack_from( '<'+str(num_lower)+'Q', mm, offset + self.__sizes.lower_base ) )
+                result.leaf = num_lower == 0
+
+            # Unless its corrupt
+            except ( ValueError, struct.error ):
+                corrupt = True
 
-            # Find less used cached record
-            min = 0
-            for i in range( len( self.__node_cache ) ):
-                if self.__node_cache[i]['hits'] < self.__node_cache[min]['hits']:
-                    min = i
+            # If corrupt raise exception
+            if corrupt:
+                raise RuntimeError('B-Tree file is corrupt')
 
-            # Remove it
-            del self.__node_cache[min]
+        # Moving on: If cache is full, remove least recently used node other than root
+        if len( self.__node_cache ) >= self.__cache_size:
+            for victim in self.__node_cache:
+                if victim != self.__tree_header['root_offset']:
+                    del self.__node_cache[victim]
+                    break
 
         # Add new record to cache
-        self.__node_cache.append( { 'offset': offset, 'hits': 1, 'node': result.copy() } )
+        self.__node_cache[offset] = result
         
         return result
         
     # ----------------------------------------------------------------------
 
-    def __binsearch__( self, key, lis, beg = 0 , _end = -1 ):
+    def __rec_search__( self, offset, key ):
 
-        # Default to whole list
-        end = _end
-        if end == -1:
-            end = len( lis )
-            
-        # If empty list, return
-        if beg == end:
-            return beg
-
-        # Calculate pivot position
-        p = trunc( ( beg + end ) / 2 )
+        # Bind what's used on every level to locals
+        load_node = self.__load_node__
+        node_cache = self.__node_cache
+        madvise = self.__madvise
+        node_size = self.__sizes.node_size
+        mm = self.__mm
 
-        # If key lower than pivot, recursively search lower half
-        if key < lis[p]:
-            return self.__binsearch__( key, lis, beg, p )
+        # Descend from offset, one level per loop
+        while True:
 
-        # If key higher than pivot, recursively search higher half
-        elif key > lis[p]:
-            return self.__binsearch__( key, lis, p + 1, end )
+            # Load node from disk
+            node = load_node( offset )
 
-        # Otherwise, found it.
-        return p
-    
-    # ----------------------------------------------------------------------
-        
-    def __rec_search__( self, fd, offset, key ):
+            # Search within keys
+            position, exists = node.search( key )
 
-        corrupt = False
-        
-        # Initialize result
-        result = { 'node': None,'position':0, 'exists': False }
-
-        # Load node from disk
-        result['node'] = self.__load_node__( fd, offset )
-
-        # Search within keys
-        result['position'] = self.__binsearch__( key, result['node']['key'] )
-        
-        # Test if found
-        try:
-            if result['node']['key'][result['position']] == key:
-                result['exists'] = True
-        except IndexError:
-                result['exists'] = False
-
-        # If found or if it's a leaf, return this node
-        if result['exists'] or len(result['node']['lower_node']) == 0:
-            return result 
-                
-        # Otherwise, do recursive call
-        return self.__rec_search__( fd, result['node']['lower_node'][result['position']], key )
+            # If found or if it's a leaf, return this node
+            if exists or node.leaf:
+                return { 'node': node, 'position': position, 'exists': exists }
 
+            # Otherwise, go down. If lower node isn't cached, ask the kernel to read
+            # all its pages at once rather than faulting them in one by one. Hint
+            # must start on a system page, which may be larger than nodes' alignment
+            offset = node.lowers[position]
+            if madvise and offset not in node_cache and offset + node_size <= len( mm ):
+                start = offset - offset % mmap.PAGESIZE
+                mm.madvise( mmap.MADV_WILLNEED, start, offset + node_size - start )
 
     # ----------------------------------------------------------------------
 
-    def __free_node__( self, fd, node ):
+    def __free_node__( self, node ):
         
 
         # Clear node
-        node['upper_node'] = 0
-        node['left_node'] = 0
-        node['right_node'] = 0
-        node['key'].clear()
-        node['data'].clear()
-        node['lower_node'].clear()
-        
-        # Save node
-        self.__save_node__( fd, node )
-
-        # Register free node
-        self.__tree_header['free_offset'].append(node['offset'])
-        self.__tree_header['free_offset'].sort()
-        self.__save_header__( fd )
-
-        # If too many free nodes
-        if len( self.__tree_header['free_offset'] ) > self.__max_free_nodes:
-
-            # Load last node in file
-            last_node = self.__load_node__( fd, self.__tree_header['last_offset'] )
+        self.__underflowed.discard( node.offset )
+        node.upper = 0
+        node.left = 0
+        node.right = 0
+        node.keys = []
+        node.data = []
+        node.leaf = True
+        node.lowers = array( 'Q' )
+        self.__header_dirty = True
+
+        # Register free node in the free list of its band
+        if node.offset < self.__tree_header['band_offset']:
+            free_offset = self.__tree_header['free_internal']
+            last_offset = self.__tree_header['next_internal_offset'] - self.__sizes.node_size
+        else:
+            free_offset = self.__tree_header['free_leaf']
+            last_offset = self.__tree_header['last_offset']
+        self.__save_node__( node )
+        insort( free_offset, node.offset )
 
-            # If last node is empty
-            if len( last_node['key'] ) == 0:
+        # If too many free nodes, move last node in band to the first free one
+        if len( free_offset ) > self.__max_free_nodes and free_offset[-1] != last_offset:
+            new_offset = free_offset.pop(0)
+            self.__move_node__( last_offset, new_offset )
 
-                # Just remove last node from list of free offsets
-                self.__tree_header['free_offset'].remove( self.__tree_header['last_offset'] )
+            # Update header if moving root
+            if last_offset == self.__tree_header['root_offset']:
+                self.__tree_header['root_offset'] = new_offset
 
-            # Otherwise
-            else:
+            insort( free_offset, last_offset )
 
-                # Move node and remove
-                new_offset = self.__tree_header['free_offset'].pop(0)
-                self.__move_node__( fd, self.__tree_header['last_offset'], new_offset )
+        # Cut free nodes off the end of band
+        while len( free_offset ) > 0 and free_offset[-1] == last_offset:
+            free_offset.pop()
+            last_offset -= self.__sizes.node_size
 
-                # Update header if moving root
-                if self.__tree_header['last_offset'] == self.__tree_header['root_offset']:
-                    self.__tree_header['root_offset'] = new_offset
+        # Internal band keeps its room
+        if node.offset < self.__tree_header['band_offset']:
+            self.__tree_header['next_internal_offset'] = last_offset + self.__sizes.node_size
 
-            # Shrink file
-            fd.seek( self.__tree_header['last_offset'] )
-            fd.truncate()
+        # Leaf band shrinks the file
+        elif last_offset != self.__tree_header['last_offset']:
+            self.__tree_header['last_offset'] = last_offset
+            self.__resize__( last_offset + self.__sizes.node_size )
 
-            # Update last_offset
-            self.__tree_header['last_offset'] -= self.__max_node_size
-            self.__save_header__( fd )
+            # Drop cached nodes past the end of file
+            for off in [off for off in self.__node_cache if off > last_offset]:
+                del self.__node_cache[off]
 
     # ----------------------------------------------------------------------
 
-    def __alloc_node__( self, fd ):
+    def __alloc_node__( self, internal = False ):
 
         node = None
-        
-        try:
-            # Get next free node
-            node = self.__load_node__( fd, self.__tree_header['free_offset'].pop(0) )
-            node['key'].clear()
-            node['data'].clear()
-            node['lower_node'].clear()
-            
-        except IndexError:
-            # If no free nodes available, create one in the end
-            fd.seek( 0, 2)
-            node = {
-                'offset': fd.tell(),
-                'upper_node': 0,
-                'left_node': 0,
-                'right_node': 0,
-                'key': [],
-                'data': [],
-                'lower_node': []
-            }
-            self.__tree_header['last_offset'] = node['offset']
-            fd.write( json.dumps( node ).ljust( self.__max_node_size, ' ' ) )
+        free_offset = self.__tree_header['free_leaf']
+
+        # Internal nodes go to their band while it has room, otherwise with the leaves
+        if internal and len( self.__tree_header['free_internal'] ) > 0:
+            free_offset = self.__tree_header['free_internal']
+        elif internal and self.__tree_header['next_internal_offset'] < self.__tree_header['band_offset']:
+            node = _Node( self.__tree_header['next_internal_offset'] )
+            self.__tree_header['next_internal_offset'] += self.__sizes.node_size
+            self.__save_node__( node )
+
+        if node is None:
+            try:
+                # Get next free node
+                node = self.__load_node__( free_offset.pop(0) )
+                node.keys = []
+                node.data = []
+                node.leaf = True
+                node.lowers = array( 'Q' )
+
+            except IndexError:
+                # If no free nodes available, create one in the end
+                node = _Node( len( self.__mm ) )
+                self.__resize__( node.offset + self.__sizes.node_size )
+                self.__tree_header['last_offset'] = node.offset
+                self.__save_node__( node )
 
         # Statistics
         self.__tree_header['stats']['nodes'] += 1
-        self.__save_header__( fd )
+        self.__header_dirty = True
         
         return node
     
     # ----------------------------------------------------------------------
     
-    def __merge_node__( self, fd, offset ):
+    def __merge_node__( self, offset ):
 
-        # Load node
-        node = self.__load_node__( fd, offset )
+        # Merge upwards while upper nodes underflow
+        while True:
 
-        # If root
-        if offset == self.__tree_header['root_offset']:
+            # Load node
+            node = self.__load_node__( offset )
+
+            # If root
+            if offset == self.__tree_header['root_offset']:
             
-            # If root is empty but with a lower node
-            if len( node['key'] ) == 0 and len( node['lower_node'] ) > 0:
-
-                # Set new root and do statistics
-                self.__tree_header['root_offset'] = node['lower_node'][0]
-                self.__tree_header['stats']['merges'] += 1
-                self.__tree_header['stats']['levels'] -= 1
-                self.__tree_header['stats']['nodes'] -= 1
-                self.__save_header__( fd )
+                # If root is empty but with a lower node
+                if len( node.keys ) == 0 and not node.leaf:
+
+                    # Set new root and do statistics
+                    self.__tree_header['root_offset'] = node.lowers[0]
+                    self.__tree_header['stats']['merges'] += 1
+                    self.__tree_header['stats']['levels'] -= 1
+                    self.__tree_header['stats']['nodes'] -= 1
+                    self.__header_dirty = True
                 
-                # Free old root
-                self.__free_node__( fd, node )
+                    # Free old root
+                    self.__free_node__( node )
                 
-                # Fix new root
-                sub = self.__load_node__( fd, self.__tree_header['root_offset'] )
-                sub['upper_node'] = 0
-                self.__save_node__( fd, sub )
+                    # Fix new root
+                    self.__save_upper__( self.__tree_header['root_offset'], 0 )
 
-            # Return
-            return
+                # Return
+                return
         
-        # Statistics
-        self.__tree_header['stats']['merges'] += 1
-        self.__save_header__( fd )
+            # Statistics
+            self.__tree_header['stats']['merges'] += 1
+            self.__stats_dirty = True
         
-        # Load upper node
-        upper_node = self.__load_node__( fd, node['upper_node'] )
+            # Load upper node
+            upper_node = self.__load_node__( node.upper )
         
-        # Load left node
-        left_node = None
-        left_occup = self.__tree_header['num_keys']
-        if node['left_node'] > 0:
-            left_node = self.__load_node__( fd, node['left_node'] )
-            left_occup = len( left_node['key'] )
+            # Load left node
+            left_node = None
+            left_occup = self.__num_keys
+            if node.left > 0:
+                left_node = self.__load_node__( node.left )
+                left_occup = len( left_node.keys )
             
-        # Load right node
-        right_node = None
-        right_occup = self.__tree_header['num_keys']
-        if node['right_node'] > 0:
-            right_node = self.__load_node__( fd, node['right_node'] )
-            right_occup = len( right_node['key'] )
-
-        # Choose merge parties and set them to left and right
-        if right_occup > left_occup:
-            right_node = node
-        else:
-            left_node = node
-
-        # Fix lower
-        for off in right_node['lower_node']:
-            sub = self.__load_node__( fd, off )
-            sub['upper_node'] = left_node['offset']
-            self.__save_node__( fd, sub )
-
-        # Fix left & right on node's level
-        left_node['right_node'] = right_node['right_node']
-        if left_node['right_node'] > 0:
-            new_right_node = self.__load_node__( fd, left_node['right_node'] )
-            new_right_node['left_node'] = left_node['offset']
-            self.__save_node__( fd, new_right_node )
-
-        # Fix left & right on node's sub level
-        if len( left_node['lower_node'] ) > 0:
-            sub = self.__load_node__( fd, left_node['lower_node'][-1] )
-            sub['right_node'] = right_node['lower_node'][0]
-            self.__save_node__( fd, sub )
-            sub = self.__load_node__( fd, right_node['lower_node'][0] )
-            sub['left_node'] = left_node['lower_node'][-1]
-            self.__save_node__( fd, sub )
+            # Load right node
+            right_node = None
+            right_occup = self.__num_keys
+            if node.right > 0:
+                right_node = self.__load_node__( node.right )
+                right_occup = len( right_node.keys )
+
+            # Choose merge parties and set them to left and right
+            if right_occup > left_occup:
+                right_node = node
+            else:
+                left_node = node
+
+            # Fix lower
+            for off in right_node.lowers:
+                self.__save_upper__( off, left_node.offset )
+
+            # Fix left & right on node's level
+            left_node.right = right_node.right
+            if left_node.right > 0:
+                new_right_node = self.__load_node__( left_node.right )
+                new_right_node.left = left_node.offset
+                self.__save_node__( new_right_node )
+
+            # Fix left & right on node's sub level
+            if not left_node.leaf:
+                sub = self.__load_node__( left_node.lowers[-1] )
+                sub.right = right_node.lowers[0]
+                self.__save_node__( sub )
+                sub = self.__load_node__( right_node.lowers[0] )
+                sub.left = left_node.lowers[-1]
+                self.__save_node__( sub )
         
-        # Find position in upper node
-        pos = self.__binsearch__( left_node['key'][-1], upper_node['key'] )
-
-        # Bring key+data down and del pointer to right
-        left_node['key'].append(upper_node['key'].pop(pos))
-        left_node['data'].append(upper_node['data'].pop(pos))
-        del upper_node['lower_node'][pos+1]
-
-        # Merge 
-        left_node['key'].extend( right_node['key'] )
-        left_node['data'].extend( right_node['data'] )
-        left_node['lower_node'].extend( right_node['lower_node'] )
+            # Find position in upper node. Left node may have no keys left
+            pos = upper_node.lowers.index( left_node.offset )
+
+            # Bring key+data down and del pointer to right
+            left_node.keys.append(upper_node.keys.pop(pos))
+            left_node.data.append(upper_node.data.pop(pos))
+            del upper_node.lowers[pos+1]
+
+            # Merge 
+            left_node.keys.extend( right_node.keys )
+            left_node.data.extend( right_node.data )
+            left_node.lowers.extend( right_node.lowers )
         
-        # Save nodes
-        for n in [left_node, upper_node]:
-            self.__save_node__( fd, n )
+            # Save nodes
+            for n in [left_node, upper_node]:
+                self.__save_node__( n )
 
-        # Free right node
-        self.__free_node__( fd, right_node )
+            # Free right node
+            self.__free_node__( right_node )
 
-        # Statistics
-        self.__tree_header['stats']['nodes'] -= 1
-        self.__save_header__( fd )
+            # Statistics
+            self.__tree_header['stats']['nodes'] -= 1
+            self.__stats_dirty = True
+
+            # Ballance upper, going up the tree instead of recursing
+            if len( upper_node.keys ) < self.__min_occup:
+                if not self.__thread_ballance__( upper_node.offset ):
+                    offset = upper_node.offset
+                    continue
 
-        # Ballance upper
-        if len( upper_node['key'] ) < self.__min_occup:
-            if not self.__thread_ballance__( fd, upper_node['offset'] ):
-                self.__merge_node__( fd, upper_node['offset'] )
+            return
         
     # ----------------------------------------------------------------------
     
-    def __split_node__( self, fd, offset ):
+    def __split_node__( self, offset ):
 
-        # Statistics
-        self.__tree_header['stats']['splits'] += 1
-        self.__save_header__( fd )
+        # Split upwards while upper nodes overflow
+        while True:
+
+            # Statistics
+            self.__tree_header['stats']['splits'] += 1
+            self.__stats_dirty = True
 
-        # Calculate pivot position
-        pivot = trunc( self.__tree_header['num_keys'] / 2 )
+            # Calculate pivot position
+            pivot = trunc( self.__num_keys / 2 )
 
-        # Load node to split, known as left node
-        left_node = self.__load_node__( fd, offset )
+            # Load node to split, known as left node
+            left_node = self.__load_node__( offset )
 
-        # Create new node, known right node - decided to always split to the right
-        right_node = self.__alloc_node__( fd )
+            # Create new node, known right node - decided to always split to the right
+            right_node = self.__alloc_node__( not left_node.leaf )
         
-        # If we are splitting the root
-        if offset == self.__tree_header['root_offset']:
+            # If we are splitting the root
+            if offset == self.__tree_header['root_offset']:
 
-            # Statistics
-            self.__tree_header['stats']['levels'] += 1
-            self.__save_header__( fd )
+                # Statistics
+                self.__tree_header['stats']['levels'] += 1
+                self.__stats_dirty = True
             
-            # Create upper node (new root) and set first lower node. Second will come in pivot promotion
-            upper_node = self.__alloc_node__( fd )
-            upper_node['lower_node'].insert( 0, left_node['offset'] )
+                # Create upper node (new root) and set first lower node. Second will come in pivot promotion
+                upper_node = self.__alloc_node__( True )
+                upper_node.leaf = False
+                upper_node.lowers.insert( 0, left_node.offset )
             
-            # Update and save tree header
-            self.__tree_header['root_offset'] = upper_node['offset']
-            self.__save_header__( fd )
+                # Update and save tree header
+                self.__tree_header['root_offset'] = upper_node.offset
+                self.__header_dirty = True
                         
-        # Otherwise, just load upper node
-        else:
-            upper_node = self.__load_node__( fd, left_node['upper_node'] )
+            # Otherwise, just load upper node
+            else:
+                upper_node = self.__load_node__( left_node.upper )
             
-        # Promote pivot to upper node
-        pos = self.__binsearch__( left_node['key'][pivot], upper_node['key'] )
-        upper_node['key'].insert( pos, left_node['key'][pivot] )
-        upper_node['data'].insert( pos, left_node['data'][pivot] )
-        upper_node['lower_node'].insert( pos+1, right_node['offset'] )
-
-        # Split key array and data array
-        right_node['key'] = left_node['key'][pivot+1:]
-        right_node['data'] = left_node['data'][pivot+1:]
-        left_node['key'] = left_node['key'][:pivot]
-        left_node['data'] = left_node['data'][:pivot]
-
-        # Set new left, right and upper in the new node
-        right_node['upper_node'] = upper_node['offset']
-        right_node['left_node'] = left_node['offset']
-        right_node['right_node'] = left_node['right_node']
-
-        # Set new right and upper in the splitted node (upper update will be needed in root split)
-        left_node['upper_node'] = upper_node['offset']
-        left_node['right_node'] = right_node['offset']
-
-        # If inherited right neighbor exists, update right neighbor's left_node pointer to new node
-        if right_node['right_node'] > 0:
-            rn = self.__load_node__( fd, right_node['right_node'] )
-            rn['left_node'] = right_node['offset']
-            self.__save_node__( fd, rn )
-
-        # If splitted and new node have lower lower nodes
-        if len( left_node['lower_node'] ) > 0:
+            # Promote pivot to upper node
+            pos = bisect_left( upper_node.keys, left_node.keys[pivot] )
+            upper_node.keys.insert( pos, left_node.keys[pivot] )
+            upper_node.data.insert( pos, left_node.data[pivot] )
+            upper_node.lowers.insert( pos+1, right_node.offset )
+
+            # Split key array and data array, trimming left ones in place
+            right_node.keys = left_node.keys[pivot+1:]
+            right_node.data = left_node.data[pivot+1:]
+            del left_node.keys[pivot:]
+            del left_node.data[pivot:]
+
+            # Set new left, right and upper in the new node
+            right_node.upper = upper_node.offset
+            right_node.left = left_node.offset
+            right_node.right = left_node.right
+
+            # Set new right and upper in the splitted node (upper update will be needed in root split)
+            left_node.upper = upper_node.offset
+            left_node.right = right_node.offset
+
+            # If inherited right neighbor exists, update right neighbor's left_node pointer to new node
+            if right_node.right > 0:
+                rn = self.__load_node__( right_node.right )
+                rn.left = right_node.offset
+                self.__save_node__( rn )
+
+            # If splitted and new node have lower lower nodes
+            if not left_node.leaf:
             
-            # split lower node pointer array
-            right_node['lower_node'] = left_node['lower_node'][pivot+1:]
-            left_node['lower_node'] = left_node['lower_node'][:pivot+1]
-
-            # point upper node to new node in lower nodes moved to new node
-            for off in right_node['lower_node']:
-                sub = self.__load_node__( fd, off )
-                sub['upper_node'] = right_node['offset']
-                self.__save_node__( fd, sub )
-
-            # Zero left neighbor of node pointed by pointer at [pivot+1] because now such pointer is on the left edge
-            sub = self.__load_node__( fd, right_node['lower_node'][0] )
-            sub['left_node']=0
-            self.__save_node__( fd, sub )
+                # split lower node pointer array
+                right_node.leaf = False
+                right_node.lowers = left_node.lowers[pivot+1:]
+                del left_node.lowers[pivot+1:]
+
+                # point upper node to new node in lower nodes moved to new node
+                for off in right_node.lowers:
+                    self.__save_upper__( off, right_node.offset )
+
+                # Zero left neighbor of node pointed by pointer at [pivot+1] because now such pointer is on the left edge
+                sub = self.__load_node__( right_node.lowers[0] )
+                sub.left=0
+                self.__save_node__( sub )
             
-            # Zero right neighbor of node pointed by pointer at [pivot-1] because now such pointer is on the right-most position
-            sub = self.__load_node__( fd, left_node['lower_node'][-1] )
-            sub['right_node']=0    
-            self.__save_node__( fd, sub )
-
-        # Save current node, new neighbor and new root
-        for node in [left_node, right_node, upper_node]:
-            self.__save_node__( fd, node )
-
-        # Ballance upper node
-        if len(upper_node['key']) == self.__tree_header['num_keys']:
-            if not self.__thread_ballance__( fd, upper_node['offset'] ):
-                self.__split_node__( fd, upper_node['offset'] )
+                # Zero right neighbor of node pointed by pointer at [pivot-1] because now such pointer is on the right-most position
+                sub = self.__load_node__( left_node.lowers[-1] )
+                sub.right=0    
+                self.__save_node__( sub )
+
+            # Save current node, new neighbor and new root
+            for node in [left_node, right_node, upper_node]:
+                self.__save_node__( node )
+
+            # Ballance upper node, going up the tree instead of recursing
+            if len(upper_node.keys) == self.__num_keys:
+                if not self.__thread_ballance__( upper_node.offset ):
+                    offset = upper_node.offset
+                    continue
+
+            return
     
     # ----------------------------------------------------------------------
 
-    def __thread_ballance__( self, fd, offset ):
+    def __thread_ballance__( self, offset ):
 
         ret = False
         direction = None
@@ -600,29 +1038,29 @@ class b3dict( MutableMapping ):
         taker = None
 
         # Load node
-        node = self.__load_node__( fd, offset )
-        occup = len( node['key'] )
+        node = self.__load_node__( offset )
+        occup = len( node.keys )
 
         # Can't thread if I'm root
-        if node['upper_node'] == 0:
+        if node.upper == 0:
             return ret
         
         # Load upper node
-        upper_node = self.__load_node__( fd, node['upper_node'] )
+        upper_node = self.__load_node__( node.upper )
         
         # Load left node
         left_node = None
         left_occup = 0
-        if node['left_node'] > 0:
-            left_node = self.__load_node__( fd, node['left_node'] )
-            left_occup = len( left_node['key'] )
+        if node.left > 0:
+            left_node = self.__load_node__( node.left )
+            left_occup = len( left_node.keys )
 
         # Load right node
         right_node = None
         right_occup = 0
-        if node['right_node'] > 0:
-            right_node = self.__load_node__( fd, node['right_node'] )
-            right_occup = len( right_node['key'] )
+        if node.right > 0:
+            right_node = self.__load_node__( node.right )
+            right_occup = len( right_node.keys )
 
         # If underflow
         if occup < self.__min_occup:
@@ -661,38 +1099,39 @@ class b3dict( MutableMapping ):
             
             # Statistics
             self.__tree_header['stats']['threads to left'] += 1
-            self.__save_header__( fd )
+            self.__stats_dirty = True
 
             # Find position in upper node
-            pos = self.__binsearch__( giver['key'][0], upper_node['key'] ) - 1
+            pos = bisect_left( upper_node.keys, giver.keys[0] ) - 1
 
             # Thread key and data
-            for par in ['key', 'data']:
-                taker[par].append( upper_node[par][pos] )
-                upper_node[par][pos] = giver[par].pop(0)
+            taker.keys.append( upper_node.keys[pos] )
+            upper_node.keys[pos] = giver.keys.pop(0)
+            taker.data.append( upper_node.data[pos] )
+            upper_node.data[pos] = giver.data.pop(0)
 
             # If has lower nodes
-            if len( giver['lower_node'] ) > 0:
+            if not giver.leaf:
 
                 # Move pointer
-                taker['lower_node'].append( giver['lower_node'].pop(0) )
+                taker.lowers.append( giver.lowers.pop(0) )
 
                 # Fix left & right for node at offset=ptr
-                sub = self.__load_node__( fd, taker['lower_node'][-1] )
-                sub['upper_node'] = taker['offset']
-                sub['right_node'] = 0
-                sub['left_node'] = taker['lower_node'][-2]
-                self.__save_node__( fd, sub )
+                sub = self.__load_node__( taker.lowers[-1] )
+                sub.upper = taker.offset
+                sub.right = 0
+                sub.left = taker.lowers[-2]
+                self.__save_node__( sub )
 
                 # Fix left for ex right node
-                sub = self.__load_node__( fd, giver['lower_node'][0] )
-                sub['left_node'] = 0
-                self.__save_node__( fd, sub )
+                sub = self.__load_node__( giver.lowers[0] )
+                sub.left = 0
+                self.__save_node__( sub )
 
                 # Fix right for new left node
-                sub = self.__load_node__( fd, taker['lower_node'][-2] )
-                sub['right_node'] = taker['lower_node'][-1]
-                self.__save_node__( fd, sub )
+                sub = self.__load_node__( taker.lowers[-2] )
+                sub.right = taker.lowers[-1]
+                self.__save_node__( sub )
                 
             ret = True
 
@@ -701,38 +1140,39 @@ class b3dict( MutableMapping ):
 
             # Statistics
             self.__tree_header['stats']['threads to right'] += 1
-            self.__save_header__( fd )
+            self.__stats_dirty = True
 
             # Find position in upper node
-            pos = self.__binsearch__( giver['key'][-1], upper_node['key'] )
+            pos = bisect_left( upper_node.keys, giver.keys[-1] )
 
             # Thread key and data
-            for par in ['key', 'data']:
-                taker[par].insert( 0, upper_node[par][pos] )
-                upper_node[par][pos] = giver[par].pop(-1)
+            taker.keys.insert( 0, upper_node.keys[pos] )
+            upper_node.keys[pos] = giver.keys.pop(-1)
+            taker.data.insert( 0, upper_node.data[pos] )
+            upper_node.data[pos] = giver.data.pop(-1)
                 
             # If has lower nodes
-            if len( giver['lower_node'] ) > 0:
+            if not giver.leaf:
 
                 # Move pointer
-                taker['lower_node'].insert( 0, giver['lower_node'].pop(-1) )
+                taker.lowers.insert( 0, giver.lowers.pop(-1) )
                 
                 # Fix left & right for node at offset=ptr
-                sub = self.__load_node__( fd, taker['lower_node'][0] )
-                sub['upper_node'] = taker['offset']
-                sub['right_node'] = taker['lower_node'][1]
-                sub['left_node'] = 0
-                self.__save_node__( fd, sub )
+                sub = self.__load_node__( taker.lowers[0] )
+                sub.upper = taker.offset
+                sub.right = taker.lowers[1]
+                sub.left = 0
+                self.__save_node__( sub )
 
                 # Fix right for ex left node
-                sub = self.__load_node__( fd, giver['lower_node'][-1] )
-                sub['right_node'] = 0
-                self.__save_node__( fd, sub )
+                sub = self.__load_node__( giver.lowers[-1] )
+                sub.right = 0
+                self.__save_node__( sub )
 
                 # Fix left for new right node
-                sub = self.__load_node__( fd, taker['lower_node'][1] )
-                sub['left_node'] = taker['lower_node'][0]
-                self.__save_node__( fd, sub )
+                sub = self.__load_node__( taker.lowers[1] )
+                sub.left = taker.lowers[0]
+                self.__save_node__( sub )
                 
             ret = True
 
@@ -741,12 +1181,12 @@ class b3dict( MutableMapping ):
 
             # Save nodes
             for n in [taker, giver, upper_node]:
-                self.__save_node__( fd, n )
+                self.__save_node__( n )
 
             # Ballance taker if it's almost full to give room to next thread ballance.
             # This should keep occupation homogeneous across tree level
-            if len(taker['key']) == ( self.__tree_header['num_keys'] - 1 ):
-                self.__thread_ballance__( fd, taker['offset'] )
+            if len(taker.keys) == ( self.__num_keys - 1 ):
+                self.__thread_ballance__( taker.offset )
             
         return ret
 
@@ -754,14 +1194,10 @@ class b3dict( MutableMapping ):
 
     def check_consistency( self ):
 
-        # Open b-tree file
-        fd = open( self.__file_name, 'r+' )
-
-        # Recursive check
-        result = self.__check_consistency__( fd, self.__tree_header['root_offset'], 0, 0 )
+        self.__check_open__()
 
-        # Close file
-        fd.close()
+        # Depth-first check
+        result = self.__check_consistency__( self.__tree_header['root_offset'] )
 
         if result == None:
             return False
@@ -770,72 +1206,94 @@ class b3dict( MutableMapping ):
     
     # ----------------------------------------------------------------------
 
-    def __check_consistency__( self, fd, offset, left, right ):
+    def __check_consistency__( self, root_offset ):
 
-        node = self.__load_node__( fd, offset )
-
-        # Check for node overflow
-        if len( node['key'] ) >= self.__tree_header['num_keys']:
-            return None
-            
-        # Check for underflow in non-root nodes
-        if len( node['key'] ) < self.__min_occup:
-            if node['offset'] == self.__tree_header['root_offset']:
-                return { 'min': 0, 'max': 0, 'upper_offset': 0 }
-            else:
-                print("Node em "+str(offset)+" tem = "+str(len( node['key'] ))+" nodes, quando num_keys = "+str(self.__tree_header['num_keys']))
-                return None
+        # Walk the tree with an explicit stack instead of recursing. Each node is
+        # checked on its own when first reached, then again against the ranges of
+        # its lower nodes once all of them are done. Any problem fails the whole check
+        results = {}
+        stack = [ [ root_offset, None, 0, 0, None ] ]
 
-        if node['left_node'] != left:
-            print("Node em "+str(offset)+" pensa que left = "+str(node['left_node'])+", quanto na verdade left = "+str(left))
-            return None
+        while len( stack ) > 0:
+            entry = stack[-1]
+            offset, upper, left, right, node = entry
 
-        if node['right_node'] != right:
-            print("Node em "+str(offset)+" pensa que right = "+str(node['right_node'])+", quanto na verdade right = "+str(right))
-            return None
+            # First visit
+            if node == None:
+                node = self.__load_node__( offset )
+                entry[4] = node
 
-        # Initialize max and min
-        min_key = node['key'][-1]
-        max_key = node['key'][0]
-        
-        # If not leaf
-        if len( node['lower_node'] ) > 0:
+                # Check upper pointer right away, so a corrupt pointer can't loop
+                if upper != None and node.upper != upper:
+                    return None
 
-            # Check how many lower nodes
-            if len( node['lower_node'] ) != (len( node['key'] ) + 1):
-                return None
+                # Check for node overflow
+                if len( node.keys ) >= self.__num_keys:
+                    return None
             
-            for i in range( len( node['key'] ) ):
-
-                # Check left
-                if i > 0:
-                    _left = node['lower_node'][i-1]
-                else:
-                    _left = 0
-                _right = node['lower_node'][i+1]
-                left_consistency = self.__check_consistency__( fd, node['lower_node'][i], _left, _right )
-                                
-                # Check right
-                _left = node['lower_node'][i]
-                if i+1 < len(node['key']):
-                    _right = node['lower_node'][i+2]
-                else:
-                    _right = 0
-                right_consistency = self.__check_consistency__( fd, node['lower_node'][i+1], _left, _right )
-
-                if left_consistency == None or right_consistency == None:
+                # Check for underflow in non-root nodes, as far as deletions ballance them.
+                # Deferred underflow leaves them short until compacted, but never empty
+                if len( node.keys ) == 0 or ( self.__underflows__( len( node.keys ) ) and not self.__tree_header['underflow'] ):
+                    if node.offset == self.__tree_header['root_offset']:
+                        results[offset] = { 'min': 0, 'max': 0 }
+                        stack.pop()
+                        continue
+                    else:
+                        _log.error( 'Node at offset=%d has %d keys, with num_keys = %d', offset, len( node.keys ), self.__num_keys )
+                        return None
+
+                if node.left != left:
+                    _log.error( 'Node at offset=%d thinks left = %d, but actual left = %d', offset, node.left, left )
                     return None
-                
-                if left_consistency['upper_offset'] != offset or right_consistency['upper_offset'] != offset:
+
+                if node.right != right:
+                    _log.error( 'Node at offset=%d thinks right = %d, but actual right = %d', offset, node.right, right )
                     return None
+
+                # If not leaf, check lower nodes first
+                if not node.leaf:
+
+                    # Check how many lower nodes
+                    if len( node.lowers ) != (len( node.keys ) + 1):
+                        return None
+
+                    # Push them with the neighbors they should point to, first one on top
+                    lowers = node.lowers
+                    for i in range( len( lowers ) - 1, -1, -1 ):
+                        _left = lowers[i-1] if i > 0 else 0
+                        _right = lowers[i+1] if i+1 < len( lowers ) else 0
+                        stack.append( [ lowers[i], offset, _left, _right, None ] )
+                    continue
+
+                # If leaf, if next key is not higher than current key, problem detected
+                for i in range( len( node.keys )- 1 ):
+                    if node.keys[i+1] <= node.keys[i]:
+                        _log.error( 'Inconsistency in node at offset=%d', node.offset )
+                        return None
+
+                results[offset] = { 'min': node.keys[0], 'max': node.keys[-1] }
+                stack.pop()
+                continue
+
+            # Second visit, lower nodes are done: initialize max and min
+            min_key = node.keys[-1]
+            max_key = node.keys[0]
+
+            for i in range( len( node.keys ) ):
+                left_consistency = results[node.lowers[i]]
+                right_consistency = results[node.lowers[i+1]]
                 
-                if left_consistency['max'] >= node['key'][i] or right_consistency['min'] <= node['key'][i] or node['key'][i] < max_key:
-                    print('Inconsistency in node at offset='+str(node['offset'])+" ["+str(i)+"]")
-                    print("Left offset = "+str(node['lower_node'][i]))
-                    print("Max left  = '"+left_consistency['max']+"'")
-                    print("Right offset = "+str(node['lower_node'][i+1]))
-                    print("Min right = '"+right_consistency['min']+"'")
-                    print("node: "+str(node['offset'])+": "+str(node['key']))
+                if left_consistency['max'] >= node.keys[i] or right_consistency['min'] <= node.keys[i] or node.keys[i] < max_key:
+                    # Decoding keys for the report is only worth it if it's logged
+                    if _log.isEnabledFor( logging.ERROR ):
+                        _log.error( "Inconsistency in node at offset=%d [%d]\n"
+                                    "Left offset = %d\nMax left  = '%s'\n"
+                                    "Right offset = %d\nMin right = '%s'\n"
+                                    "node: %d: %s",
+                                    node.offset, i,
+                                    node.lowers[i], self.__decode_key__( left_consistency['max'] ),
+                                    node.lowers[i+1], self.__decode_key__( right_consistency['min'] ),
+                                    node.offset, [ self.__decode_key__( k ) for k in node.keys ] )
                     return None
                 
                 if left_consistency['min'] < min_key:
@@ -844,50 +1302,77 @@ class b3dict( MutableMapping ):
                 if right_consistency['max'] > max_key:
                     max_key = right_consistency['max']
 
-        # If leaf
-        else:
-            
-            # If next key is not higher than current key, problem detected
-            for i in range( len( node['key'] )- 1 ):
-                if node['key'][i+1] <= node['key'][i]:
-                    print('Inconsistency in node at offset='+str(node['offset']))
-                    return None
-            min_key = node['key'][0]
-            max_key = node['key'][-1]
+            # Lower nodes results aren't needed anymore
+            for off in node.lowers:
+                results.pop( off, None )
+
+            results[offset] = { 'min': min_key, 'max': max_key }
+            stack.pop()
                 
-        return { 'min': min_key, 'max': max_key, 'upper_offset': node['upper_node'] }
+        return results[root_offset]
     
     # ----------------------------------------------------------------------
     
-    def __to_str__( self, obj ):
+    def __encode_key__( self, key ):
 
-        if isinstance( obj, str ):
-            return obj
+        # Keys are stored and compared as NUL padded UTF-8 in fixed-size slots
+        if not isinstance( key, str ):
+            raise TypeError( 'Key must be a str.' )
 
-        elif isinstance( obj, dict ) or isinstance( obj, list ):
-            return json.dumps( obj )
+        # Trailing NULs would read back as padding. Such keys can't be stored, so pad
+        # them one byte past the slot, which never matches a stored key
+        if key.endswith( '\0' ):
+            return key.encode().ljust( self.__sizes.key_size + 1, b'\0' )
+        return key.encode().ljust( self.__sizes.key_size, b'\0' )
 
-        else:
-            return str( obj )
+    # ----------------------------------------------------------------------
+
+    def __decode_key__( self, key ):
+
+        return key.rstrip( b'\0' ).decode()
+
+    # ----------------------------------------------------------------------
+
+    def __check_key__( self, key ):
+
+        # Encode key, refusing the ones that don't fit their slot
+        encoded = self.__encode_key__( key )
+        if key.endswith( '\0' ):
+            raise ValueError( 'Key can\'t end with a NUL character.' )
+        if len( encoded ) > self.__sizes.key_size:
+            raise ValueError( 'Key is too big. Limit is '+str(self.__sizes.key_size)+' bytes.' )
+        return encoded
+
+    # ----------------------------------------------------------------------
+
+    def __encode_data__( self, value ):
+
+        # Data is stored as JSON in fixed-size slots
+        data = _json_dumps( value )
+        if len( data ) > self.__sizes.data_size:
+            raise ValueError( 'Value is too big. Limit is '+str(self.__sizes.data_size)+' bytes.' )
+
+        return data
     
     # ----------------------------------------------------------------------
 
-    def __pop_max__( self, fd, offset ):
+    def __pop_max__( self, offset ):
 
         # Load node
-        node = self.__load_node__( fd, offset )
+        node = self.__load_node__( offset )
         
         # Load right-most lower node until it finds a leaf
-        while len(node['lower_node']) > 0:
-            node = self.__load_node__( fd, node['lower_node'][-1] )
+        while not node.leaf:
+            node = self.__load_node__( node.lowers[-1] )
             
         # Capture and remove right-most key and data
-        max = { 'key': node['key'][-1], 'data':node['data'][-1], 'offset': node['offset'] }
-        del node['key'][-1]
-        del node['data'][-1]
+        max = { 'key': node.keys[-1], 'data': node.data[-1], 'offset': node.offset, 'node': node }
+        del node.keys[-1]
+        del node.data[-1]
+        max['remaining_keys'] = len( node.keys )
 
         # Save node
-        self.__save_node__( fd, node );
+        self.__save_node__( node );
 
         # Return
         return max
@@ -899,68 +1384,211 @@ class b3dict( MutableMapping ):
     
     # ----------------------------------------------------------------------
 
-    def __move_node__( self, fd, old_offset, new_offset ):
+    def __underflows__( self, num_keys ):
+
+        # Node that lost a key needs ballance. Below 100 percent, nodes may stay
+        # under minimum occupation, but never empty
+        return num_keys < self.__min_occup * self.__rebalance_percent // 100 or num_keys == 0
+
+    # ----------------------------------------------------------------------
+
+    def __is_free__( self, offset ):
+
+        # Offset is not holding a node: in a free list, past used band or past end of file
+        if offset in self.__tree_header['free_internal'] or offset in self.__tree_header['free_leaf']:
+            return True
+        if offset < self.__tree_header['band_offset']:
+            return offset >= self.__tree_header['next_internal_offset']
+        return offset > self.__tree_header['last_offset']
+
+    # ----------------------------------------------------------------------
+
+    def __defer_underflow__( self, offset ):
+
+        # Remember node for compaction, and flag it in the header so a run that
+        # doesn't close leaves a file that is compacted when opened
+        self.__underflowed.add( offset )
+        if not self.__tree_header['underflow']:
+            self.__tree_header['underflow'] = True
+            self.__header_dirty = True
+
+    # ----------------------------------------------------------------------
+
+    def __compact__( self, scan = False ):
+
+        # After a run that didn't close, deferred nodes are only known by scanning
+        if scan:
+            stack = [ self.__tree_header['root_offset'] ]
+            while len( stack ) > 0:
+                offset = stack.pop()
+                node = self.__load_node__( offset )
+                if offset != self.__tree_header['root_offset'] and len( node.keys ) < self.__min_occup:
+                    self.__underflowed.add( offset )
+                stack.extend( node.lowers )
+
+        # Ballance nodes left under minimum occupation. Ballancing frees and moves
+        # nodes, which keeps the set up to date, and a node may need it again
+        while len( self.__underflowed ) > 0:
+            offset = self.__underflowed.pop()
+            if self.__is_free__( offset ) or offset == self.__tree_header['root_offset']:
+                continue
+            if len( self.__load_node__( offset ).keys ) < self.__min_occup:
+                if not self.__thread_ballance__( offset ):
+                    self.__merge_node__( offset )
+                self.__underflowed.add( offset )
+                self.__flush__()
+
+        # Tree is ballanced again
+        if self.__tree_header['underflow']:
+            self.__tree_header['underflow'] = False
+            self.__header_dirty = True
+            self.__flush__()
+
+    # ----------------------------------------------------------------------
+
+    @contextmanager
+    def bulk_load( self ):
+
+        # Skip ballance on deletions inside the block, then compact once at the end
+        rebalance_percent = self.__rebalance_percent
+        self.__rebalance_percent = 0
+        try:
+            yield self
+        finally:
+            self.__rebalance_percent = rebalance_percent
+            self.__compact__()
+
+    # ----------------------------------------------------------------------
+
+    def close( self ):
+
+        # Write pending changes, sync them to disk and release the file. Ballance
+        # whatever deletions left under minimum occupation first
+        if self.__mm is not None:
+            self.__compact__()
+            self.__flush__( True )
+            self.__mm.flush()
+            self.__mm.close()
+            self.__mm = None
+
+            # Cached nodes would otherwise keep answering for the closed file
+            self.__node_cache.clear()
+            self.__dirty_nodes.clear()
+
+    def __check_open__( self ):
+
+        # Like file objects, refuse operations once closed
+        if self.__mm is None:
+            raise ValueError( 'B-Tree file is closed' )
+
+    def __del__( self ):
+
+        # Don't lose pending changes when the tree is dropped without close().
+        # Constructor may have failed before setting attributes up
+        try:
+            self.close()
+        except AttributeError:
+            pass
+
+    def __enter__( self ):
+        return self
+
+    def __exit__( self, exc_type, exc_value, traceback ):
+        self.close()
+
+    # ----------------------------------------------------------------------
+
+    def __move_node__( self, old_offset, new_offset ):
 
         # Load nodes
+        upper_node = None
         left_node = None
         right_node = None
-        node = self.__load_node__( fd, old_offset )
-        upper_node = self.__load_node__( fd, node['upper_node'] )
-        if node['left_node'] > 0:
-            left_node = self.__load_node__( fd, node['left_node'] )
-        if node['right_node'] > 0:
-            right_node = self.__load_node__( fd, node['right_node'] )
-        
-        # Find position in upper node
-        pos = self.__binsearch__( node['key'][-1], upper_node['key'] )
-
-        # Update pointers
-        node['offset'] = new_offset
-        upper_node['lower_node'][pos] = new_offset
-        if node['left_node'] > 0:
-            left_node['right_node'] = new_offset
-        if node['right_node'] > 0:
-            right_node['left_node'] = new_offset
+        node = self.__load_node__( old_offset )
+        if node.upper > 0:
+            upper_node = self.__load_node__( node.upper )
+        if node.left > 0:
+            left_node = self.__load_node__( node.left )
+        if node.right > 0:
+            right_node = self.__load_node__( node.right )
+
+        # Update pointers. Cached node is shared, so drop it from its old offset,
+        # reading its data before the old slot is reused
+        node.read_data()
+        node.offset = new_offset
+        if old_offset in self.__underflowed:
+            self.__underflowed.remove( old_offset )
+            self.__underflowed.add( new_offset )
+        self.__node_cache.pop( old_offset, None )
+        self.__dirty_nodes.pop( old_offset, None )
+        if node.upper > 0:
+            upper_node.lowers[upper_node.lowers.index( old_offset )] = new_offset
+        if node.left > 0:
+            left_node.right = new_offset
+        if node.right > 0:
+            right_node.left = new_offset
         
         # Save nodes
         for n in [node, left_node, right_node, upper_node]:
             if n != None:
-                self.__save_node__( fd, n )
+                self.__save_node__( n )
 
         # Update lower nodes
-        if len( node['lower_node'] ) > 0:
-            for off in node['lower_node']:
-                sub = self.__load_node__( fd, off )
-                sub['upper_node'] = new_offset
-                self.__save_node__( fd, sub )
+        if not node.leaf:
+            for off in node.lowers:
+                self.__save_upper__( off, new_offset )
 
     # ----------------------------------------------------------------------
 
-    def __iter_check_end__( self, fd ):
+    def __walk__( self, reverse = False ):
+
+        # In order traversal keeping the path from root as a stack of [node, position]
+        # frames, where position is the lower node being visited. All state lives in
+        # the generator, so iterators don't interfere with each other.
+        self.__check_open__()
+
+        stack = []
+        node = self.__load_node__( self.__tree_header['root_offset'] )
+        while True:
+
+            # Go down to the first (or last) leaf, stacking nodes on the way
+            while not node.leaf:
+                pos = len( node.keys ) if reverse else 0
+                stack.append( [ node, pos ] )
+                node = self.__load_node__( node.lowers[pos] )
+
+            # Keys of the leaf
+            keys = node.keys
+            for key in ( keys[::-1] if reverse else keys ):
+                yield self.__decode_key__( key )
+                self.__check_open__()
+
+            # Go up to the first node with keys left, return its key and go down next lower node
+            while stack:
+                frame = stack[-1]
+                upper = frame[0]
+                pos = frame[1]
+                if reverse and pos > 0:
+                    pos -= 1
+                    key = upper.keys[pos]
+                elif not reverse and pos < len( upper.keys ):
+                    key = upper.keys[pos]
+                    pos += 1
+                else:
+                    stack.pop()
+                    continue
+                frame[1] = pos
+                yield self.__decode_key__( key )
 
-        # If position is either before first key or after last key
-        if self.__iter_pos == len( self.__iter_node['key'] ) or self.__iter_pos == -1:
+                # Tree may have been closed while suspended
+                self.__check_open__()
+                node = self.__load_node__( upper.lowers[pos] )
+                break
 
-            # If root, we're done
-            if self.__iter_node['offset'] == self.__tree_header['root_offset']:
-                self.__iter_dir = 'direct'
-                raise ( StopIteration )
-                                                                
+            # Back at root with no keys left
             else:
-                
-                # Find next position in upper node
-                min_key = self.__iter_node['key'][0]
+                return
 
-                # Update iter
-                self.__iter_node = self.__load_node__( fd, self.__iter_node['upper_node'] )
-                self.__iter_pos = self.__binsearch__( min_key, self.__iter_node['key'] )
-                
-                if self.__iter_dir == 'reverse':
-                    self.__iter_pos -= 1
-                    
-                # Check upwards
-                self.__iter_check_end__( fd )
-                    
     # ----------------------------------------------------------------------
 
     def __missing__(self, key):
@@ -1002,21 +1630,17 @@ class b3dict( MutableMapping ):
         # instead of __getitem__(). See __class_getitem__ versus __getitem__ for
         # more details.
 
-        # Open b-tree file
-        fd = open( self.__file_name, 'r' )
+        self.__check_open__()
 
         # Search for key
-        result = self.__rec_search__( fd, self.__tree_header['root_offset'], key )
-
-        # Close file
-        fd.close()
+        result = self.__rec_search__( self.__tree_header['root_offset'], self.__encode_key__( key ) )
 
         # If not found, KeyError exception
         if not result['exists']:
             self.__missing__( key )
 
         # Return
-        return result['node']['data'][result['position']]
+        return _json_loads( result['node'].get_data( result['position'] ) )
 
     def __setitem__(self, key, value):
         # Called to implement assignment to self[key]. Same note as for __getitem__().
@@ -1027,39 +1651,117 @@ class b3dict( MutableMapping ):
 
         #print("\nAdicionando: "+key+" ==> "+json.dumps(value))
         
-        # Check value size
-        if len( self.__to_str__( value ) ) > self.__max_data_size:
-            raise ValueError("Value is too big. Limit is "+str(self.__max_data_size)+" bytes.")
-        
-        # Open b-tree file
-        fd = open( self.__file_name, 'r+' )
+        self.__check_open__()
 
+        # Encode key and value
+        key = self.__check_key__( key )
+        data = self.__encode_data__( value )
+        
         # Search for key
-        result = self.__rec_search__( fd, self.__tree_header['root_offset'], key )
+        result = self.__rec_search__( self.__tree_header['root_offset'], key )
 
         # If found, update data
         if result['exists']:
-            result['node']['data'][result['position']] = value
+            result['node'].data[result['position']] = data
 
         # If not found, insert new pair key/data 
         else:
-            result['node']['key'].insert( result['position'], key )
-            result['node']['data'].insert( result['position'], value )
+            result['node'].keys.insert( result['position'], key )
+            result['node'].data.insert( result['position'], data )
             # Statistics
             self.__tree_header['stats']['keys'] += 1
-            self.__save_header__( fd )
+            self.__stats_dirty = True
 
         # Save node
-        self.__save_node__( fd, result['node'] )
+        self.__save_node__( result['node'] )
 
         # Ballance node
-        if len(result['node']['key']) == self.__tree_header['num_keys']:
-            if not self.__thread_ballance__( fd, result['node']['offset'] ):
-                self.__split_node__( fd, result['node']['offset'] )
+        if len(result['node'].keys) == self.__num_keys:
+            if not self.__thread_ballance__( result['node'].offset ):
+                self.__split_node__( result['node'].offset )
 
-        # Close file
-        fd.close()
+        # Write header
+        self.__flush__()
         
+    def update( self, other = (), /, **kwds ):
+        # Bulk insert or update. Pairs are applied in key order, so consecutive keys
+        # that fall in the same leaf are added without searching from root again.
+        self.__check_open__()
+
+        # Check and encode all keys first, so a bad one doesn't leave the update half
+        # done. Values are encoded as they're applied, so they aren't all held encoded
+        if hasattr( other, 'keys' ):
+            other = [ ( key, other[key] ) for key in other.keys() ]
+        pairs = [ ( self.__check_key__( key ), value ) for key, value in other ]
+        pairs += [ ( self.__check_key__( key ), value ) for key, value in kwds.items() ]
+
+        # Stable sort keeps the last value given for a repeated key last
+        pairs.sort( key = lambda pair: pair[0] )
+
+        # Bind what's used on every pair to locals
+        load_node = self.__load_node__
+        save_node = self.__save_node__
+        num_keys = self.__num_keys
+        stats = self.__tree_header['stats']
+
+        node = None
+        low = None
+        high = None
+        try:
+            for key, value in pairs:
+                data = self.__encode_data__( value )
+
+                # Unless key falls within the current leaf key range, search from root
+                # narrowing the range at each level
+                if node is None or ( low is not None and key <= low ) or ( high is not None and key >= high ):
+
+                    # Write nodes changed while in the previous leaf, so pending writes
+                    # stay bounded by what one leaf and its ballance touch
+                    self.__flush__()
+
+                    node = load_node( self.__tree_header['root_offset'] )
+                    low = None
+                    high = None
+                    while True:
+                        pos, exists = node.search( key )
+                        if exists or node.leaf:
+                            break
+                        if pos > 0:
+                            low = node.get_key( pos - 1 )
+                        if pos < node.num_keys():
+                            high = node.get_key( pos )
+                        node = load_node( node.lowers[pos] )
+                else:
+                    pos, exists = node.search( key )
+
+                # If found, update data
+                if exists:
+                    node.data[pos] = data
+
+                # If not found, insert new pair key/data 
+                else:
+                    node.keys.insert( pos, key )
+                    node.data.insert( pos, data )
+                    # Statistics
+                    stats['keys'] += 1
+                    self.__stats_dirty = True
+
+                # Save node
+                save_node( node )
+
+                # Ballance node, which moves keys among nodes, so search again next time.
+                # Same if key was found in an upper node
+                if len( node.keys ) == num_keys:
+                    if not self.__thread_ballance__( node.offset ):
+                        self.__split_node__( node.offset )
+                    node = None
+                elif not node.leaf:
+                    node = None
+
+        # Write nodes and header, also when a value can't be encoded
+        finally:
+            self.__flush__()
+
     def __delitem__(self, key):
         # Called to implement deletion of self[key]. Same note as for __getitem__().
         # This should only be implemented for mappings if the objects support removal
@@ -1067,60 +1769,58 @@ class b3dict( MutableMapping ):
         # same exceptions should be raised for improper key values as for the
         # __getitem__() method.
 
-        # Open b-tree file
-        fd = open( self.__file_name, 'r+' )
+        self.__check_open__()
 
         # Search for key
-        result = self.__rec_search__( fd, self.__tree_header['root_offset'], key )
+        result = self.__rec_search__( self.__tree_header['root_offset'], self.__encode_key__( key ) )
 
-        # If not found
+        # If not found, KeyError exception
         if not result['exists']:
-            
-            # Close file <-- Now, that's discipline!
-            fd.close()
-            
-            # KeyError exception
             raise KeyError(key)
 
         # Statistics
         self.__tree_header['stats']['keys'] -= 1
-        self.__save_header__( fd )
+        self.__stats_dirty = True
 
         
         # If not leaf
-        if len( result['node']['lower_node'] ) > 0:
+        if not result['node'].leaf:
 
             # Replace deleted key with max key from left subtree
-            max = self.__pop_max__( fd, result['node']['lower_node'][result['position']] )
-            result['node']['key'][result['position']] = max['key']
-            result['node']['data'][result['position']] = max['data']
+            max = self.__pop_max__( result['node'].lowers[result['position']] )
+            result['node'].keys[result['position']] = max['key']
+            result['node'].data[result['position']] = max['data']
 
             # Save node
-            self.__save_node__( fd, result['node'] );
+            self.__save_node__( result['node'] );
 
             # Ballance popped node which lost its max key
-            popped = self.__load_node__( fd, max['offset'] )
-            if len( popped['key'] ) < self.__min_occup:
-                if not self.__thread_ballance__( fd, max['offset'] ):
-                    self.__merge_node__( fd, max['offset'] )
+            if self.__underflows__( max['remaining_keys'] ):
+                if not self.__thread_ballance__( max['offset'] ):
+                    self.__merge_node__( max['offset'] )
+            elif max['remaining_keys'] < self.__min_occup:
+                self.__defer_underflow__( max['offset'] )
             
         # If leaf
         else:
             
             # Remove
-            del result['node']['key'][result['position']]
-            del result['node']['data'][result['position']]
+            del result['node'].keys[result['position']]
+            del result['node'].data[result['position']]
 
             # Save node
-            self.__save_node__( fd, result['node'] );
+            self.__save_node__( result['node'] );
         
-        # Ballance node
-        if len( result['node']['key'] ) < self.__min_occup:
-            if not self.__thread_ballance__( fd, result['node']['offset'] ):
-                self.__merge_node__( fd, result['node']['offset'] )
+            # Ballance node. An upper node keeps its number of keys, and merges below
+            # it already ballance it, maybe even freeing or moving it
+            if self.__underflows__( len( result['node'].keys ) ):
+                if not self.__thread_ballance__( result['node'].offset ):
+                    self.__merge_node__( result['node'].offset )
+            elif len( result['node'].keys ) < self.__min_occup and result['node'].offset != self.__tree_header['root_offset']:
+                self.__defer_underflow__( result['node'].offset )
 
-        # Close file
-        fd.close()
+        # Write header
+        self.__flush__()
 
     def __iter__(self):
         # This method is called when an iterator is required for a container. This
@@ -1128,80 +1828,7 @@ class b3dict( MutableMapping ):
         # objects in the container. For mappings, it should iterate over the keys of
         # the container.
 
-        # Open b-tree file
-        fd = open( self.__file_name, 'r+' )
-
-        # Load root
-        self.__iter_node = self.__load_node__( fd, self.__tree_header['root_offset'] )
-
-        # Find min leaf and set position
-        while len( self.__iter_node['lower_node'] ) > 0:
-            if self.__iter_dir == 'direct':
-                self.__iter_node = self.__load_node__( fd, self.__iter_node['lower_node'][0] )
-                self.__iter_pos=0
-            else:
-                self.__iter_node = self.__load_node__( fd, self.__iter_node['lower_node'][-1] )
-                self.__iter_pos = len( self.__iter_node['key'] ) - 1
-
-        # Close file
-        fd.close()
-
-        # Return
-        return self
-        
-    def __next__(self):
-        # This method is called when an iterator is required for a container. This
-        # method should return a new iterator object that can iterate over all the
-        # objects in the container. For mappings, it should iterate over the keys of
-        # the container.
-
-        # Open b-tree file
-        fd = open( self.__file_name, 'r+' )
-
-        # Check if reached end of key array
-        self.__iter_check_end__( fd )
-
-        # Capture Data
-        result = self.__iter_node['key'][self.__iter_pos]
-
-        # If leaf
-        if len( self.__iter_node['lower_node'] ) == 0:
-
-            if self.__iter_dir == 'direct':
-                # Advance position
-                self.__iter_pos += 1
-            else:
-                # Retreat position
-                self.__iter_pos -= 1
-        
-        # If not leaf
-        else:
-            
-            if self.__iter_dir == 'direct':
-                
-                # Load lower
-                self.__iter_node = self.__load_node__( fd, self.__iter_node['lower_node'][self.__iter_pos+1] )
-
-                # Find min leaf
-                while len( self.__iter_node['lower_node'] ) > 0:
-                    self.__iter_node = self.__load_node__( fd, self.__iter_node['lower_node'][0] )
-
-                # Set position
-                self.__iter_pos = 0
-            else:
-
-                # Load lower
-                self.__iter_node = self.__load_node__( fd, self.__iter_node['lower_node'][self.__iter_pos] )
-
-                # Find max leaf
-                while len( self.__iter_node['lower_node'] ) > 0:
-                    self.__iter_node = self.__load_node__( fd, self.__iter_node['lower_node'][-1] )
-
-                # Set position
-                self.__iter_pos = len( self.__iter_node['key'] ) - 1
-
-        # Return
-        return result
+        return self.__walk__()
         
     def __reversed__(self):
         # Called (if present) by the reversed() built-in to implement reverse
@@ -1217,8 +1844,7 @@ class b3dict( MutableMapping ):
         # following special method with a more efficient implementation, which also
         # does not require the object be iterable.
 
-        self.__iter_dir = 'reverse'
-        return self
+        return self.__walk__( True )
 
     def __contains__(self, item):
         # Called to implement membership test operators. Should return true if item is
@@ -1228,14 +1854,10 @@ class b3dict( MutableMapping ):
         # tries iteration via __iter__(), then the old sequence iteration protocol via
         # __getitem__(), see this section in the language reference.
 
-        # Open b-tree file
-        fd = open( self.__file_name, 'r' )
+        self.__check_open__()
 
         # Search for key
-        result = self.__rec_search__( fd, self.__tree_header['root_offset'], item )
-
-        # Close file
-        fd.close()
+        result = self.__rec_search__( self.__tree_header['root_offset'], self.__encode_key__( item ) )
 
         # Return
         return result['exists']
@@ -0,0 +1,74 @@
+# cython: language_level=3, boundscheck=False, wraparound=False
+
+####################################################################################################################
+#   B-Tree Dictionary - compiled node helpers                                            author: Ticiano Benetti   #
+####################################################################################################################
+#                                                                                                                  #
+# Description: Optional C versions of the per-node routines used by b3dictionary. If this module isn't built,     #
+#              b3dictionary falls back to equivalent pure Python code.                                             #
+#                                                                                                                  #
+# Build:       python setup.py build_ext --inplace                                                                 #
+#                                                                                                                  #
+####################################################################################################################
+
+from libc.string cimport memcmp
+
+# --------------------------------------------------------------------------
+
+def split_keys( bytes slab, Py_ssize_t key_size ):
+
+    # Split a slab of fixed-width key slots into a list of keys
+    cdef Py_ssize_t pos
+    return [ slab[pos:pos+key_size] for pos in range( 0, len( slab ), key_size ) ]
+
+# --------------------------------------------------------------------------
+
+cdef Py_ssize_t _binsearch( const unsigned char *slab, Py_ssize_t n, const unsigned char *probe, Py_ssize_t key_size ) nogil:
+
+    # Leftmost slot not lower than probe
+    cdef Py_ssize_t low = 0
+    cdef Py_ssize_t high = n
+    cdef Py_ssize_t mid
+
+    while low < high:
+        mid = ( low + high ) >> 1
+        if memcmp( slab + mid * key_size, probe, key_size ) < 0:
+            low = mid + 1
+        else:
+            high = mid
+
+    return low
+
+# --------------------------------------------------------------------------
+
+def split_data( bytes slab, Py_ssize_t data_size ):
+
+    # Split a slab of data slots into a list of values, without their NUL padding
+    cdef const unsigned char *buf = slab
+    cdef Py_ssize_t pos
+    cdef Py_ssize_t end
+    result = []
+
+    for pos in range( 0, len( slab ), data_size ):
+        end = pos + data_size
+        while end > pos and buf[end - 1] == 0:
+            end -= 1
+        result.append( slab[pos:end] )
+
+    return result
+
+# --------------------------------------------------------------------------
+
+def search_keys( const unsigned char[:] slab, Py_ssize_t n, bytes key, Py_ssize_t key_size ):
+
+    # Position of key among the first n slots of slab, and whether it's there
+    cdef const unsigned char *probe = key
+    cdef Py_ssize_t pos
+
+    if len( key ) != key_size:
+        raise ValueError( '<key> must be exactly key_size bytes' )
+    if n == 0:
+        return 0, False
+
+    pos = _binsearch( &slab[0], n, probe, key_size )
+    return pos, pos < n and memcmp( &slab[pos * key_size], probe, key_size ) == 0
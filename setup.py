@@ -0,0 +1,21 @@
+#!/usr/bin/python
+
+from setuptools import setup
+
+# Compiled node helpers are optional, b3dictionary runs without them
+try:
+    from Cython.Build import cythonize
+    ext_modules = cythonize( 'b3node.pyx' )
+except ImportError:
+    ext_modules = []
+
+setup(
+    name = 'b3dict',
+    version = '0.1',
+    description = 'Python dictionary with a B-tree file behind it',
+    author = 'Ticiano Benetti',
+    license = 'GPLv3',
+    python_requires = '>=3.10',
+    py_modules = [ 'b3dictionary' ],
+    ext_modules = ext_modules,
+)